@@ -13,245 +13,276 @@ This compiler does several things:
 import argparse
 import os
 import pprint
-import shlex
 import struct
 import sys
 import zlib
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
 
+# precompiled struct formats
+_U16 = struct.Struct(">H")
+_U32 = struct.Struct(">I")
 
-class LabelPlaceholder:
-    def __init__(self, label_name: str):
-        self.label_name = label_name
 
-    def resolve(self, table: dict):
-        """
-        Resolves the jump address for this label.
-        """
-        return table[self.label_name][0].to_bytes(2, byteorder="big")
+def resolve_label(label_name: str, table: dict) -> bytes:
+    """
+    Resolves the jump address for a label.
+    """
+    if label_name not in table:
+        print(f"error: unknown label {label_name} to resolve")
+        sys.exit(1)
 
-    # used for moving the pointer ahead
-    def __len__(self):
-        return 2
+    return _U16.pack(table[label_name][0])
+
+
+def parse_int(value: str) -> int:
+    """
+    Parses an integer operand, in any base Python understands.
+    """
+    try:
+        return int(value, 0)
+    except ValueError:
+        print(f"error: invalid integer `{value}`")
+        sys.exit(1)
+
+
+def encode_u16(value: int) -> bytes:
+    """
+    Encodes a 16-bit operand.
+    """
+    if not 0 <= value <= 0xffff:
+        print(f"error: operand {value} does not fit in 16 bits")
+        sys.exit(1)
+
+    return _U16.pack(value)
 
 
 # register mapping
+# the register IDs are stored pre-encoded, as that's all the compiler ever needs
 R_MAP = {
-    "MAR": 8,
-    "MVR": 9,
-    "PC": 10,
-    **{"R{}".format(v): v for v in range(0, 8)}
+    name: _U16.pack(v) for name, v in {
+        "MAR": 8,
+        "MVR": 9,
+        "PC": 10,
+        **{"R{}".format(v): v for v in range(0, 8)}
+    }.items()
 }
 
+# opcodes
+# the two byte ones are followed by a two byte operand, the four byte ones are whole instructions
+_OP_NOP = b"\x00\x00\x00\x00"
+_OP_HLT = b"\x00\x01\x00\x00"
+_OP_SL = b"\x00\x02"
+_OP_SPOP = b"\x00\x03"
+_OP_LLBL = b"\x00\x04"
+_OP_RGW = b"\x00\x10"
+_OP_RGR = b"\x00\x11"
+_OP_MMR = b"\x00\x12"
+_OP_MMW = b"\x00\x13"
+_OP_JMPR = b"\x00\x20"
+_OP_RET = b"\x00\x21\x00\x00"
+_OP_JMPA = b"\x00\x23\x00\x00"
+_OP_ADD = b"\x00\x30\x00\x00"
+_OP_MUL = b"\x00\x31\x00\x00"
+_OP_SUB = b"\x00\x032\x00\x00"
+
 
 # function definitions
-# all functions take one arg, the line
-# and returns an iterable of bytestrings or similar
-def compile_nop(line: str):
+# all functions take two args, the line and the label table
+# and returns the bytestring for the instruction
+def compile_nop(line: str, labels: dict):
     # fmt: `nop`
-    return [b"\x00\x00\x00\x00"]
+    return _OP_NOP
 
 
-def compile_hlt(line: str):
+def compile_hlt(line: str, labels: dict):
     # fmt: `hlt`
     # halts the CPU
-    return [b"\x00\x01\x00\x00"]
+    return _OP_HLT
 
 
 # stack operations
-def compile_sl(line: str):
+def compile_sl(line: str, labels: dict):
     # fmt: `sl <int>`
     # puts a literal on the stack
-    val = int(line, 0)
+    val = parse_int(line)
 
     if val > 0xffff:
         # figure out how many times we need to multiply it by 32767
         # then ADD the remainder
         mul_amount = val // 0x7fff
         remainder = val % 0x7fff
-        return [
-            b"\x00\x02", mul_amount.to_bytes(2, byteorder="big"),
+        return b"".join((
+            _OP_SL, encode_u16(mul_amount),
             # stack load the amount to multiply
-            b"\x00\x02", b"\x7f\xff",  # stack load 32767
-            b"\x00\x31", b"\x00\x00",  # call the multiplication op
-            b"\x00\x02", remainder.to_bytes(2, byteorder="big"),  # load remainder
-            b"\x00\x30", b"\x00\x00"  # call the addition op
-        ]
+            _OP_SL, b"\x7f\xff",  # stack load 32767
+            _OP_MUL,  # call the multiplication op
+            _OP_SL, encode_u16(remainder),  # load remainder
+            _OP_ADD  # call the addition op
+        ))
 
-    return [b"\x00\x02", val.to_bytes(2, byteorder="big")]
+    return _OP_SL + encode_u16(val)
 
 
-def compile_spop(line: str):
+def compile_spop(line: str, labels: dict):
     # fmt: `spop <i>`
     # pops the top <x> items from the stack
     if line:
-        val = int(line, 0)
+        val = parse_int(line)
     else:
         val = 1
 
-    return [b"\x00\x03", val.to_bytes(2, byteorder="big")]
+    return _OP_SPOP + encode_u16(val)
 
 
-def compile_llbl(line: str):
+def compile_llbl(line: str, labels: dict):
     # fmt: `llbl <label>`
     # loads the address of a label onto the stack
-    pl = LabelPlaceholder(line)
-
-    return [
-        b"\x00\x04", pl
-    ]
+    return _OP_LLBL + resolve_label(line, labels)
 
 
 # register operations
-def compile_rgw(line: str):
+def compile_rgw(line: str, labels: dict):
     # fmt: `rgw <reg>`
     # pops the top item from the stack, and writes it to the register
-    reg = line.upper()
-
-    return [b"\x00\x10", R_MAP[reg].to_bytes(2, byteorder="big")]
+    return _OP_RGW + R_MAP[line.upper()]
 
 
-def compile_rgr(line: str):
+def compile_rgr(line: str, labels: dict):
     # fmt: `rgr <reg>`
     # reads the value from the register and puts it on the stack
-    reg = line.upper()
-
-    return [b"\x00\x11", R_MAP[reg].to_bytes(2, byteorder="big")]
+    return _OP_RGR + R_MAP[line.upper()]
 
 
-def compile_mmr(line: str):
+def compile_mmr(line: str, labels: dict):
     # fmt: `mmr`
     # reads from memory into the MVR with the address specified by the MAR
 
     # the 2nd arg is the number of bytes to read
     if line:
-        val = int(line, 0)
+        val = parse_int(line)
     else:
         val = 4
 
-    return [b"\x00\x12", val.to_bytes(2, byteorder="big")]
+    return _OP_MMR + encode_u16(val)
 
 
-def compile_mmw(line: str):
+def compile_mmw(line: str, labels: dict):
     # fmt: `mmw`
     # writes from memory from the MVR to memory with the address specified by the MAR
 
     # the 2nd arg is the number of bytes to write
     if line:
-        val = int(line, 0)
+        val = parse_int(line)
     else:
         val = 4
 
-    return [b"\x00\x13", val.to_bytes(2, byteorder="big")]
+    return _OP_MMW + encode_u16(val)
 
 
 # jump operations
-def compile_jmpl(line: str):
+def compile_jmpl(line: str, labels: dict):
     # fmt: `jmpl <label>`
     # JuMP Label. This will jump to the specified label.
     # this is NOT a real instruction!
     # it compiles to `llbl <label>; jmpa`.
     # it is not recommended to use this; use `jmpl` instead.
 
-    pl = LabelPlaceholder(line)
+    return b"".join((
+        _OP_LLBL, resolve_label(line, labels),  # llbl label
+        _OP_JMPA  # jump absolute
+    ))
 
-    code = [
-        b"\x00\x04", pl,  # llbl label
-        b"\x00\x23", b"\x00\x00"  # jump absolute
-    ]
 
-    return code
-
-
-def compile_jmpr(line: str):
+def compile_jmpr(line: str, labels: dict):
     # fmt: `jmpr <label>`
     # this will place the current memory location at 4 * R7, increase R7, then jump to the label
 
-    # get a label placeholder that we need to jump to label
-    pl = LabelPlaceholder(line)
-
-    code = [
-        b"\x00\x20", pl
-    ]
+    return _OP_JMPR + resolve_label(line, labels)
 
-    return code
 
-
-def compile_ret(line: str):
+def compile_ret(line: str, labels: dict):
     # fmt: `ret`
     # RETurn from jump
     # This will jump to the address specified in the jump stack by the pointer in R7.
 
-    code = [
-        b"\x00\x21\x00\x00"
-    ]
-
-    return code
+    return _OP_RET
 
 
-def compile_jmpa(line: str):
+def compile_jmpa(line: str, labels: dict):
     # fmt: `jmpa`
     # JuMP Absolute. This will jump to the absolute address, specified by TOS.
     # It is very rare that this is needed explicitly; a JMPL or JMPR will often be better.
-    return [b"\x00\x23\x00\x00"]
+    return _OP_JMPA
 
 
 # math operations
-def compile_add(line: str):
+def compile_add(line: str, labels: dict):
     # fmt: `add [val]`
     # if val is not specified, it will load from the stack
-    ins = []
     if line:
-        val = int(line, 0).to_bytes(length=2, byteorder="big")
-        ins.extend([b"\x00\x02", val])
+        return _OP_SL + encode_u16(parse_int(line)) + _OP_ADD
 
-    return ins + [b"\x00\x30\x00\x00"]
+    return _OP_ADD
 
 
 # im not 100% mean
 # so I do actually allow a multiplication op
 # rather than forcing multiple adds
-def compile_mul(line: str):
+def compile_mul(line: str, labels: dict):
     # fmt: `mul [val]`
     # multiples TOS by the value provided
     # if no value is provided, it will use TOS
-    instruction = []
-
     if line:
-        val = int(line, 0).to_bytes(length=2, byteorder="big")
-        instruction.extend([b"\x00\x02", val])
+        return _OP_SL + encode_u16(parse_int(line)) + _OP_MUL
 
-    instruction.extend([b"\x00\x31\x00\x00"])
-    return instruction
+    return _OP_MUL
 
 
-def compile_sub(line: str):
+def compile_sub(line: str, labels: dict):
     # fmt: `sub [val]`
     # multiplies TOS by the value provided
     # if no value is provided, it will use TOS
-    instruction = []
-
     if line:
-        val = int(line, 0).to_bytes(length=2, byteorder="big")
-        instruction.extend([b"\x00\x02", val])
+        return _OP_SL + encode_u16(parse_int(line)) + _OP_SUB
 
-    instruction.extend([b"\x00\x032\x00\x00"])
-    return instruction
+    return _OP_SUB
 
 
-def kl27_compile(args: argparse.Namespace):
-    print("compiling", args.infile)
+# instruction name to compile function mapping
+# built once at import, so the main loop doesn't have to look up globals() per line
+OPCODES = {
+    name[len("compile_"):]: fn for name, fn in list(globals().items())
+    if name.startswith("compile_")
+}
+
+# instructions that load the address of a label, and their size in bytes
+# these can't be compiled until every label has an address, so space is reserved for them instead
+LABEL_OPS = {
+    "llbl": 4,
+    "jmpl": 8,
+    "jmpr": 4,
+}
 
-    with open(args.infile) as f:
-        data = f.read()
 
+def parse_source(args: argparse.Namespace, lines):
+    """
+    The first pass of the compiler.
+
+    This preprocesses the source, builds the label table and compiles every instruction that
+    doesn't reference a label.
+    Returns the machine code, the label table and the back-patch list of
+    (offset, compile function, label) for the instructions that still need compiling, or None if
+    the source is invalid.
+    """
     # current offset
     current_pointer = 0
     # label to address mapping
     label_table = OrderedDict()
     # machine code memory
-    code = []
+    code = bytearray()
+    # instructions to compile once every label has an address
+    patches = []
     # current includes table
     # prevents re-including files
     includes = []
@@ -259,26 +290,32 @@ def kl27_compile(args: argparse.Namespace):
     # current label
     current_label = None
 
-    lines = data.splitlines()
+    # lines left to process, included files are pushed onto the front
+    pending = deque(lines)
+    # only used for diagnostics
     lineno = 0
 
     # preprocessor checks
     def process_include(line: str):
         # this is the file we want to include
-        second = shlex.split(line)[1]
+        second = line.partition(" ")[2].strip().strip("\"'")
+        if not second:
+            print("error: no file specified to include")
+            sys.exit(1)
+
         if not os.path.exists(second):
             print(f"error: no such file: {second}")
             sys.exit(1)
 
         with open(second) as f:
             firstline = f.readline()
-            firstline = firstline.replace("\n", "").replace("\r", "")
+            firstline = firstline.rstrip("\r\n")
             if not firstline[0:3] == "#ID":
                 print(f"warning: included file '{second}' does not have an ID directive.\n"
                       f"\tThis file could potentially be included multiple times.")
                 f.seek(0)
             else:
-                id = " ".join(firstline.split(" ")[1:])
+                id = firstline.partition(" ")[2]
                 if id in includes:
                     # don't re-include
                     print(f"not re-including file '{second}")
@@ -287,23 +324,20 @@ def kl27_compile(args: argparse.Namespace):
                 includes.append(id)
                 print(f"including file '{second}' ")
 
-            newlines = f.read()
+            # queue the new lines up to be processed next
+            pending.extendleft(reversed(f.readlines()))
 
-        # insert the new lines into the `lines` count
-        # this is a hacky slice assignment
-        lines[lineno:lineno] = newlines.splitlines()
+    # preprocessor directive to function mapping
+    preprocessors = {
+        "include": process_include,
+    }
 
-    while True:
-        # load the next line from splitlines
-        try:
-            line = lines[lineno]
-        except IndexError:
-            break
-        else:
-            lineno += 1
+    while pending:
+        line = pending.popleft()
+        lineno += 1
 
         # clean up shit whitespace
-        line = line.lstrip().rstrip()
+        line = line.strip()
         # ignore whitespace
         if not line:
             continue
@@ -314,11 +348,11 @@ def kl27_compile(args: argparse.Namespace):
 
         # preprocessor check
         if line.startswith("#"):
-            processor = line.split(" ")[0][1:]
-            func = locals().get(f"process_{processor}")
-            if not func:
+            processor = line.partition(" ")[0][1:]
+            func = preprocessors.get(processor)
+            if func is None:
                 print(f"error: line {lineno}: unknown statement `{processor}`")
-                return 1
+                return None
             else:
                 # call the preprocessor
                 func(line)
@@ -332,40 +366,73 @@ def kl27_compile(args: argparse.Namespace):
                 print(f"warning: redefined label {current_label}, old code is unreachable")
 
             label_table[current_label] = (len(label_table), current_pointer)
-            print(f"\ncompiling label {current_label} at address {current_pointer}")
+            if args.verbose:
+                print(f"\ncompiling label {current_label} at address {current_pointer}")
             # don't increment the pointer, labels don't have pointers
             continue
 
         if current_label is None:
             if args.no_automatic_main:
                 print(f"error: line {lineno}: no label specified.")
-                return 1
+                return None
             print("warning: no label specified, assuming main")
             print("(pass --no-automatic-main to disable this)")
             current_label = "main"
             label_table[current_label] = (len(label_table), current_pointer)
 
-        instruction = line.split(" ")[0]
+        instruction, _, rest = line.partition(" ")
+        name = instruction.lower()
 
         # extract the function to compile the instruction
-        glob = globals()
-        func = f"compile_{instruction.lower()}"
-        if func not in glob:
+        f = OPCODES.get(name)
+        if f is None:
             print(f"error: line {lineno}: in label {current_label}:\n\t unknown instruction "
                   f"`{instruction}`.")
-            return 1
-        print(f"compiling instruction {instruction} at address {hex(current_pointer)} inside "
-              f"{current_label}")
+            return None
+
+        if args.verbose:
+            print(f"compiling instruction {instruction} at address {hex(current_pointer)} inside "
+                  f"{current_label}")
+
+        size = LABEL_OPS.get(name)
+        if size is None:
+            # call with the rest of the line to parse and construct
+            code += f(rest, label_table)
+        else:
+            # reserve space, and compile it once the label addresses are known
+            patches.append((current_pointer, f, rest))
+            code += bytes(size)
+
+        current_pointer = len(code)
+
+    return code, label_table, patches
+
+
+def fix_jumps(code: bytearray, label_table: dict, patches: list, verbose: bool = False):
+    """
+    The second pass of the compiler.
+
+    This compiles the instructions in the back-patch list into the space reserved for them, now
+    that every label has an address.
+    """
+    for offset, f, label in patches:
+        instructions = f(label, label_table)
+        code[offset:offset + len(instructions)] = instructions
+
+        if verbose:
+            print(f"resolving jump for `{label}` to `{hex(label_table[label][1])}`")
+
+
+def kl27_compile(args: argparse.Namespace):
+    print("compiling", args.infile)
+
+    with open(args.infile, buffering=1 << 20) as f:
+        result = parse_source(args, f)
 
-        f = glob[func]
-        # call with the rest of the line to parse and construct
-        instructions = f(" ".join(line.split(" ")[1:]))
-        if instructions:
-            code.extend(instructions)
+    if result is None:
+        return 1
 
-        # increment the pointer by the length of instructions produced
-        to_incr = sum(len(x) for x in instructions)
-        current_pointer += to_incr
+    code, label_table, patches = result
 
     print("\nlabel table:")
     pprint.pprint(label_table)
@@ -380,53 +447,30 @@ def kl27_compile(args: argparse.Namespace):
     # generate the header
 
     print("\ngenerating label table...")
-    final_label_table = [
-        len(label_table).to_bytes(length=2, byteorder="big")
-    ]
-
-    for id, addr in label_table.values():
-        # pack the (id, addr)
-        final_label_table.append(
-            struct.pack(">i", addr)
-        )
-
-    final_label_table.append(b"\xff\xff\xff\xff")
-    print("generated", len(final_label_table), "table entries")
-
-    final_label_table = b"".join(final_label_table)
-
-    resolved_labels = set()
-
-    def fix_jumps():
-        loop_code = code.copy()
-
-        for n, i in enumerate(loop_code):
-            if isinstance(i, LabelPlaceholder):
-                if i.label_name not in label_table:
-                    print(f"error: unknown label {i.label_name} to resolve")
-                    sys.exit(1)
-
-                print(f"resolving jump for `{i.label_name}` to "
-                      f"`{hex(label_table[i.label_name][1])}`")
-                # replace it with the resolved
-                code[n] = i.resolve(label_table)
-                resolved_labels.add(i.label_name)
+    # count, then the address of every label, then the end marker
+    # this is all packed in one go
+    count = len(label_table)
+    final_label_table = struct.pack(
+        f">H{count}i4s", count,
+        *(addr for id, addr in label_table.values()),
+        b"\xff\xff\xff\xff"
+    )
+    print("generated", count, "table entries")
 
     print("\nfixing jumps...")
-    fix_jumps()
+    fix_jumps(code, label_table, patches, args.verbose)
 
     print()
     # check to see if any labels were unused
+    referenced_labels = {label for offset, f, label in patches}
     for label in label_table:
         if label == args.entry_point:
             continue
 
-        if label not in resolved_labels:
+        if label not in referenced_labels:
             print(f"warning: unused label `{label}`")
 
-    final_code = b"".join(code)
-
-    print("instructions parsed (est.):", len(final_code) // 4)
+    print("instructions parsed (est.):", len(code) // 4)
 
     print("\ngenerating header...")
     header = []
@@ -437,17 +481,17 @@ def kl27_compile(args: argparse.Namespace):
     # 3: K_COMPRESS
     header += [b"\x00"]
     # 4: K_BODY, the main entry point
-    header += [entry.to_bytes(4, byteorder="big")]
+    header += [_U32.pack(entry)]
     # 5: K_STACKSIZE
-    header += [(4).to_bytes(2, byteorder="big")]
+    header += [_U16.pack(4)]
     # 6: K_CHECKSUM
-    header += [zlib.crc32(final_code).to_bytes(4, byteorder="big")]
+    header += [_U32.pack(zlib.crc32(code))]
     header = b"".join(header)
 
+    # write the whole file out in one go
+    payload = b"".join((header, final_label_table, code))
     with open(args.outfile, 'wb') as out:
-        final = out.write(header)
-        final += out.write(final_label_table)
-        final += out.write(final_code)
+        final = out.write(payload)
 
     print(f"compiled file successfully! written {final} bytes.")
 
@@ -460,6 +504,8 @@ if __name__ == "__main__":
     parser.add_argument_group("Compiler options")
     parser.add_argument("--entry-point", default="main", help="The entry point to use")
     parser.add_argument("--no-automatic-main", action="store_true")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Print every label and instruction as it is compiled")
 
     args = parser.parse_args()
 